@@ -1,14 +1,25 @@
 import os
+import sys
 import json
+import re
 import smtplib
+import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import firebase_admin
 import time
+import random
+import functools
+from string import Template
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.header import Header
+from email.utils import formataddr
 
 # --- Configuration ---
 DASHBOARD_URL = "https://avirajsalunkhe.github.io/cloud-mastery-bot" 
@@ -17,69 +28,215 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY") # Ensure this is mapped in your .yml fi
 SENDER_EMAIL = os.getenv("EMAIL_SENDER")
 SENDER_PASSWORD = os.getenv("EMAIL_PASSWORD")
 APP_ID = "cloud-devops-bot"
+MANAGE_BASE = DASHBOARD_URL.rstrip('/')
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_MAX_PER_SESSION = 100 # Gmail closes sessions after ~100 messages
+SMTP_HEALTHCHECK_EVERY = 20
+SMTP_IDLE_PROBE_SECONDS = 30 # Sessions idle longer than this are probed before reuse
+SMTP_WORKERS = 8 # Stays well under Gmail's concurrent session limit
+MAX_LINE_OCTETS = 998 # RFC 5322 line limit for an 8bit body
+PACK_WORKERS = 8
+BATCH_LIMIT = 450 # Firestore allows 500 writes per batch
+GEMINI_MAX_CONCURRENCY = 5 # Keeps parallel pack refills inside Gemini's per-minute quota
+BACKOFF_CAP = 16 # Upper bound in seconds for a single retry delay
+RETRY_AFTER_CAP = 60 # Longest server-requested wait we will sit through
+AI_TIMEOUT = (5, 45) # (connect, read) seconds, so a dead endpoint fails fast
+AI_MAX_RESPONSE_BYTES = 256 * 1024 # A 10-question pack is a few KB
 
-# Firebase Initialization
-service_account_json = os.getenv("FIREBASE_SERVICE_ACCOUNT")
-if not firebase_admin._apps:
-    try:
-        cred = credentials.Certificate(json.loads(service_account_json))
-        firebase_admin.initialize_app(cred)
-        print("✅ Firebase initialized successfully.")
-    except Exception as e:
-        print(f"❌ Failed to initialize Firebase: {e}")
-        exit(1)
+REFILL_PROMPT = (
+    "Generate exactly 10 multiple-choice questions for the {exam} certification. "
+    "Each question text MUST be extremely short (maximum 40 characters). "
+    "Return a JSON array of 10 objects. Each object must have: "
+    "'question', 'options' (array of 4), 'correctIndex' (0-3), 'explanation', and 'topic'. "
+    "Output ONLY the JSON array."
+)
+
+# Gemini (api_version, model, use_json) attempts, in order
+GEMINI_STRATEGIES = (
+    ("v1beta", "gemini-2.0-flash", True),
+    ("v1", "gemini-1.5-flash", False),
+    ("v1beta", "gemini-1.5-flash", True),
+)
+GEMINI_CONFIG = {"temperature": 0.8}
+GEMINI_JSON_CONFIG = {**GEMINI_CONFIG, "responseMimeType": "application/json"}
+
+# Learned while running, so later exams skip Gemini strategies that cannot work
+_gemini_missing = set() # (api_version, model) pairs that returned 404
+_gemini_no_json_mode = set() # (api_version, model) pairs that rejected responseMimeType
+_gemini_working = None # Strategy that last returned questions
 
-db = firestore.client()
+# Keep-alive session shared by every AI call so TLS connections are reused.
+# Retries stay disabled here; fallback between models is handled explicitly.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=Retry(total=0)))
+SESSION.headers.update({"Content-Type": "application/json"})
+_gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+JSON_ARRAY_RE = re.compile(r'\[[\s\S]*\]')
+
+# --- Email Templates (parsed once at import) ---
+MESSAGE_HEADERS = (
+    "Subject: {subject}\r\n"
+    "From: {sender}\r\n"
+    "To: {to}\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/html; charset=utf-8\r\n"
+    "Content-Transfer-Encoding: {encoding}\r\n"
+    "\r\n"
+)
+
+# Bodies go out as raw 8bit bytes, so the HTML carries CRLF line endings from the start
+QUESTION_TEMPLATE = Template("""
+        <div style='margin-bottom:25px; border-left:4px solid #3b82f6; padding-left:15px;'>
+            <div style="font-size:10px; color:#3b82f6; font-weight:bold; text-transform:uppercase;">Daily Challenge</div>
+            <b style="font-size:16px; color:#1e293b; display:block; margin-bottom:5px;">$question</b>
+            <div style="margin-top:8px; color:#64748b; font-size:13px;">Topic: $topic</div>
+        </div>""".replace("\n", "\r\n"))
+
+# The email is split around the shared question block, which is encoded once per exam
+EMAIL_HEAD_TEMPLATE = Template("""
+    <div style="font-family: sans-serif; padding:20px; background:#f1f5f9;">
+        <div style="max-width:600px; margin:auto; background:white; border-radius:24px; padding:40px; border:1px solid #e2e8f0; box-shadow: 0 4px 6px -1px rgba(0,0,0,0.1);">
+            <div style="text-align:center; margin-bottom:30px;">
+                <h1 style="color:#2563eb; margin:0; font-size:28px;">Cloud Mastery Bot</h1>
+                <div style="display:inline-block; margin-top:15px; background:#dbeafe; color:#1e40af; padding:6px 16px; border-radius:20px; font-weight:bold; font-size:12px; letter-spacing:0.5px;">
+                    🔥 $streak DAY STREAK
+                </div>
+            </div>
+            <p style="color:#475569; font-size:15px; line-height:1.6; text-align:center; margin-bottom:30px;">
+                Here is your daily <b>$exam</b> question. Challenge yourself!
+            </p>
+            """.replace("\n", "\r\n"))
+
+EMAIL_FOOT_TEMPLATE = Template("""
+            <div style="margin-top:40px; border-top:1px solid #f1f5f9; padding-top:25px; text-align:center;">
+                <a href="$manage_url" style="display:inline-block; background:#1e293b; color:white; padding:14px 30px; border-radius:12px; text-decoration:none; font-weight:bold; font-size:14px;">Manage Subscription</a>
+            </div>
+        </div>
+    </div>""".replace("\n", "\r\n"))
+
+# Pack and SMTP workers log concurrently with the main thread
+def log(line):
+    """Writes one log line, newline included, in a single call so worker threads never splice lines."""
+    sys.stdout.write(f"{line}\n")
+
+# Firebase Initialization (deferred until Firestore is first needed)
+@functools.lru_cache(maxsize=1)
+def get_db():
+    """Initializes Firebase once per process and returns the shared Firestore client."""
+    if not firebase_admin._apps:
+        try:
+            cred = credentials.Certificate(json.loads(os.getenv("FIREBASE_SERVICE_ACCOUNT")))
+            firebase_admin.initialize_app(cred)
+            log("✅ Firebase initialized successfully.")
+        except Exception as e:
+            log(f"❌ Failed to initialize Firebase: {e}")
+            exit(1)
+    return firestore.client()
+
+def __getattr__(name):
+    # Keeps `daily_question.db` working for importers without initializing at import time
+    if name == "db":
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def backoff_delay(prev_delay):
+    """Decorrelated-jitter delay, so parallel pack threads don't retry in lockstep."""
+    return random.uniform(1, min(BACKOFF_CAP, prev_delay * 3))
+
+def gemini_strategies():
+    """Orders Gemini strategies for this process: last success first, known-impossible ones dropped."""
+    strategies = [
+        s for s in GEMINI_STRATEGIES
+        if s[:2] not in _gemini_missing and not (s[2] and s[:2] in _gemini_no_json_mode)
+    ]
+    if _gemini_working in strategies:
+        strategies.remove(_gemini_working)
+        strategies.insert(0, _gemini_working)
+    return strategies
+
+def post_capped(url, request_body, headers=None):
+    """POSTs pre-encoded JSON and streams the reply, giving up once it exceeds AI_MAX_RESPONSE_BYTES.
+    Returns the (closed) response for its status and headers, plus the raw body."""
+    with SESSION.post(url, data=request_body, headers=headers, timeout=AI_TIMEOUT, stream=True) as res:
+        body = bytearray()
+        for chunk in res.iter_content(chunk_size=16 * 1024):
+            body += chunk
+            if len(body) > AI_MAX_RESPONSE_BYTES:
+                raise ValueError(f"response larger than {AI_MAX_RESPONSE_BYTES} bytes")
+    return res, bytes(body)
+
+def retry_after_seconds(res):
+    """Reads a numeric Retry-After header, or None if the server did not send one."""
+    try:
+        return float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
 
 def fetch_from_gemini(exam, prompt):
     """Attempt to get questions from Gemini API with fallback for 404s and 429s."""
+    global _gemini_working
     if not GEMINI_API_KEY: return None
     
-    strategies = [
-        ("v1beta", "gemini-2.0-flash", True),
-        ("v1", "gemini-1.5-flash", False),
-        ("v1beta", "gemini-1.5-flash", True),
-    ]
-    
-    for api_version, model, use_json in strategies:
+    contents = [{"parts": [{"text": prompt}]}]
+    encoded = {} # Strategies sharing a generationConfig send identical bytes, so encode each once
+    strategies = gemini_strategies()
+    delay = 1
+    for attempt, strategy in enumerate(strategies):
+        api_version, model, use_json = strategy
+        server_wait = None
+        throttled = True
         url = f"https://generativelanguage.googleapis.com/{api_version}/models/{model}:generateContent?key={GEMINI_API_KEY}"
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {"temperature": 0.8}
-        }
-        if use_json:
-            payload["generationConfig"]["responseMimeType"] = "application/json"
+        if use_json not in encoded:
+            encoded[use_json] = json.dumps({
+                "contents": contents,
+                "generationConfig": GEMINI_JSON_CONFIG if use_json else GEMINI_CONFIG
+            }).encode('utf-8')
             
         try:
-            res = requests.post(url, json=payload, timeout=30)
+            with _gemini_slots:
+                res, body = post_capped(url, encoded[use_json])
             if res.status_code == 200:
-                data = res.json()
-                return data['candidates'][0]['content']['parts'][0]['text']
+                data = json.loads(body)
+                text = data['candidates'][0]['content']['parts'][0]['text']
+                _gemini_working = strategy
+                return text
             elif res.status_code == 429:
-                print(f"    ⚠️ Gemini {model} rate limited (429).")
+                log(f"    ⚠️ Gemini {model} rate limited (429).")
+                server_wait = retry_after_seconds(res)
             elif res.status_code == 404:
-                print(f"    ⚠️ Gemini {model} not found (404).")
+                log(f"    ⚠️ Gemini {model} not found (404).")
+                _gemini_missing.add((api_version, model))
+                throttled = False
+            elif res.status_code == 400 and use_json and b"responseMimeType" in body:
+                log(f"    ⚠️ Gemini {model} ({api_version}) rejected JSON mode (400).")
+                _gemini_no_json_mode.add((api_version, model))
+                throttled = False
             else:
-                print(f"    ⚠️ Gemini {model} error: {res.status_code}")
+                log(f"    ⚠️ Gemini {model} error: {res.status_code}")
         except Exception as e:
-            print(f"    ⚠️ Gemini connection error: {e}")
+            log(f"    ⚠️ Gemini connection error: {e}")
             
-        # Small delay between strategies to avoid hammering
-        time.sleep(2)
+        # Jittered delay between strategies to avoid hammering; honour Retry-After when given.
+        # A missing model or unsupported JSON mode says nothing about load, so move straight on.
+        if throttled and attempt < len(strategies) - 1:
+            if server_wait is not None:
+                delay = min(RETRY_AFTER_CAP, server_wait + random.uniform(0, server_wait * 0.25))
+            else:
+                delay = backoff_delay(delay)
+            time.sleep(delay)
     return None
 
 def fetch_from_groq(exam, prompt):
     """Attempt to get questions from Groq API (Llama 3). Highly reliable free alternative."""
     if not GROQ_API_KEY: 
-        print("    ℹ️ Groq API Key not found in environment. Ensure it is mapped in daily_automation.yml.")
+        log("    ℹ️ Groq API Key not found in environment. Ensure it is mapped in daily_automation.yml.")
         return None
     
-    print(f"    🚀 Attempting Groq Fallback (Llama-3)...")
+    log(f"    🚀 Attempting Groq Fallback (Llama-3)...")
     url = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    headers = {"Authorization": f"Bearer {GROQ_API_KEY}"}
     payload = {
         "model": "llama-3.3-70b-versatile",
         "messages": [
@@ -91,30 +248,27 @@ def fetch_from_groq(exam, prompt):
     }
     
     try:
-        res = requests.post(url, json=payload, headers=headers, timeout=30)
+        res, body = post_capped(url, json.dumps(payload).encode('utf-8'), headers=headers)
         if res.status_code == 200:
-            data = res.json()
+            data = json.loads(body)
             return data['choices'][0]['message']['content']
         else:
-            print(f"    ⚠️ Groq failed with status {res.status_code}: {res.text}")
+            log(f"    ⚠️ Groq failed with status {res.status_code}: {body.decode('utf-8', 'replace')}")
     except Exception as e:
-        print(f"    ⚠️ Groq connection error: {e}")
+        log(f"    ⚠️ Groq connection error: {e}")
     return None
 
-def refill_question_bank(exam):
+def refill_question_bank(exam, daily_ref=None):
     """
     Calls Multiple AI Providers to refill the question bank.
     If Gemini fails, it automatically falls back to Groq.
+    Returns the new questions; the first one is stored already used so the
+    caller can hand it out without reading it back. When daily_ref is given,
+    that first question is recorded there in the same batch.
     """
-    print(f"🧠 Bank empty for {exam}. Refilling...")
+    log(f"🧠 Bank empty for {exam}. Refilling...")
     
-    prompt = (
-        f"Generate exactly 10 multiple-choice questions for the {exam} certification. "
-        "Each question text MUST be extremely short (maximum 40 characters). "
-        "Return a JSON array of 10 objects. Each object must have: "
-        "'question', 'options' (array of 4), 'correctIndex' (0-3), 'explanation', and 'topic'. "
-        "Output ONLY the JSON array."
-    )
+    prompt = REFILL_PROMPT.format(exam=exam)
 
     # Try Gemini First
     raw_response = fetch_from_gemini(exam, prompt)
@@ -124,44 +278,52 @@ def refill_question_bank(exam):
         raw_response = fetch_from_groq(exam, prompt)
         
     if not raw_response:
-        return False
+        return None
 
     try:
-        # Clean JSON from markdown blocks
-        clean_json = raw_response.strip()
-        if "```json" in clean_json:
-            clean_json = clean_json.split("```json")[1].split("```")[0].strip()
-        elif "```" in clean_json:
-            clean_json = clean_json.split("```")[1].split("```")[0].strip()
-        
-        # Parse response
-        data = json.loads(clean_json)
+        # JSON-mode replies parse as-is; only free-text replies need the array dug out of fences
+        try:
+            data = json.loads(raw_response)
+        except ValueError:
+            match = JSON_ARRAY_RE.search(raw_response)
+            data = json.loads(match.group(0) if match else raw_response)
         questions = data if isinstance(data, list) else data.get('questions', [])
         
         if not questions:
-            print("    ⚠️ No questions found in AI response.")
-            return False
+            log("    ⚠️ No questions found in AI response.")
+            return None
 
         # Save to Firestore Bank
+        db = get_db()
         bank_ref = db.collection('artifacts').document(APP_ID).collection('public').document('data').collection('question_bank')
-        for q in questions:
-            bank_ref.add({
+        batch = db.batch()
+        created_at = datetime.now(timezone.utc)
+        for i, q in enumerate(questions):
+            entry = {
                 "examType": exam,
                 "question_data": json.dumps([q]), 
-                "used": False,
-                "createdAt": datetime.now(timezone.utc)
-            })
-        print(f"✅ Successfully added {len(questions)} new questions to {exam} bank.")
-        return True
+                "used": i == 0,
+                "createdAt": created_at
+            }
+            if i == 0:
+                entry["usedAt"] = created_at
+                if daily_ref is not None:
+                    batch.set(daily_ref, {"examType": exam, "question_data": entry["question_data"], "createdAt": created_at})
+            batch.set(bank_ref.document(), entry)
+        batch.commit()
+        log(f"✅ Successfully added {len(questions)} new questions to {exam} bank.")
+        return questions
     except Exception as e:
-        print(f"    ⚠️ Error parsing AI response: {e}")
-        return False
+        log(f"    ⚠️ Error parsing AI response: {e}")
+        return None
 
-def get_question_from_bank(exam):
-    """Checks the database for an unused question. Refills if empty."""
+def get_question_from_bank(exam, daily_ref=None):
+    """Checks the database for an unused question. Refills if empty.
+    When daily_ref is given, the picked question is recorded there in the same write batch."""
+    db = get_db()
     bank_ref = db.collection('artifacts').document(APP_ID).collection('public').document('data').collection('question_bank')
     
-    query = bank_ref.where(filter=FieldFilter("examType", "==", exam)).where(filter=FieldFilter("used", "==", False)).limit(1).stream()
+    query = bank_ref.where(filter=FieldFilter("examType", "==", exam)).where(filter=FieldFilter("used", "==", False)).select(["question_data"]).limit(1).stream()
     
     found_doc = None
     for doc in query:
@@ -169,107 +331,242 @@ def get_question_from_bank(exam):
         break
         
     if found_doc:
-        bank_ref.document(found_doc.id).update({"used": True, "usedAt": datetime.now(timezone.utc)})
-        return found_doc.to_dict()["question_data"]
+        question_data = found_doc.to_dict()["question_data"]
+        now = datetime.now(timezone.utc)
+        batch = db.batch()
+        batch.update(bank_ref.document(found_doc.id), {"used": True, "usedAt": now})
+        if daily_ref is not None:
+            batch.set(daily_ref, {"examType": exam, "question_data": question_data, "createdAt": now})
+        batch.commit()
+        return question_data
     
-    if refill_question_bank(exam):
-        time.sleep(2) # Buffer for Firestore consistency
-        return get_question_from_bank(exam) 
+    questions = refill_question_bank(exam, daily_ref)
+    if questions:
+        return json.dumps([questions[0]])
         
     return None
 
-def send_email(user_data, questions_json):
-    if not questions_json:
-        return False
-        
+def get_daily_pack(exam):
+    """Returns today's question for an exam, reusing it if this day was already dispatched."""
+    data_ref = get_db().collection('artifacts').document(APP_ID).collection('public').document('data')
+    cache_ref = data_ref.collection('daily_packs').document(f"{exam}_{datetime.now(timezone.utc):%Y%m%d}")
+
+    # A re-run on the same day must not burn another bank question or AI call
+    snap = cache_ref.get()
+    if snap.exists:
+        log(f"♻️ Reusing today's {exam} question.")
+        return snap.to_dict()["question_data"]
+
+    return get_question_from_bank(exam, cache_ref)
+
+def one_line(value):
+    """Collapses any line breaks in a substituted value, so no bare CR/LF reaches the raw message."""
+    return " ".join(str(value).splitlines())
+
+def render_questions_html(q_list):
+    """Renders and encodes the question blocks of a pack. Built once per exam and shared by its subscribers."""
+    return "".join(
+        QUESTION_TEMPLATE.substitute(question=one_line(q['question']), topic=one_line(q.get('topic', 'General')))
+        for q in q_list
+    ).encode('utf-8')
+
+def build_message(user_data, q_html):
+    """Builds the raw RFC 5322 bytes of one subscriber's email. Pure: performs no I/O."""
+    streak = user_data.get('streak', 0) + 1
+    email = one_line(user_data['email'])
+    exam = one_line(user_data.get('examType', 'Certification'))
+    manage_url = f"{MANAGE_BASE}/?tab=manage&email={email}"
+
+    head = EMAIL_HEAD_TEMPLATE.substitute(streak=streak, exam=exam)
+    foot = EMAIL_FOOT_TEMPLATE.substitute(manage_url=manage_url)
+    # Only the small per-subscriber parts are encoded here; q_html is already bytes
+    body = b"".join((head.encode('utf-8'), q_html, foot.encode('utf-8')))
+    encoding = "8bit"
+    if max(map(len, body.split(b"\r\n"))) > MAX_LINE_OCTETS:
+        # An overlong AI answer would break the 8bit line limit, so this message goes out as base64
+        encoding = "base64"
+        body = base64.encodebytes(body).replace(b"\n", b"\r\n")
+
+    headers = MESSAGE_HEADERS.format(
+        subject=Header(f"🚀 Day {streak}: Your {exam} Question", 'utf-8').encode(linesep='\r\n'),
+        sender=formataddr(("Cloud Mastery Bot", SENDER_EMAIL)),
+        to=email,
+        encoding=encoding,
+    )
+    return headers.encode('utf-8') + body
+
+def open_smtp():
+    """Opens one authenticated SMTP session to be reused for many recipients."""
+    s = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=30)
+    s.login(SENDER_EMAIL, SENDER_PASSWORD)
+    return s
+
+def close_smtp(smtp):
+    """Closes an SMTP session, ignoring errors from an already dropped connection."""
     try:
-        q_list = json.loads(questions_json)
+        smtp.quit()
+    except Exception:
+        pass
+
+def smtp_alive(smtp):
+    """Cheap NOOP health check on an open SMTP session."""
+    try:
+        return smtp.noop()[0] == 250
     except Exception:
         return False
 
-    streak = user_data.get('streak', 0) + 1
-    email = user_data['email']
-    exam = user_data.get('examType', 'Certification')
-    manage_url = f"{DASHBOARD_URL.rstrip('/')}/?tab=manage&email={email}"
-    
-    q_html = ""
-    for q in q_list:
-        q_html += f"""
-        <div style='margin-bottom:25px; border-left:4px solid #3b82f6; padding-left:15px;'>
-            <div style="font-size:10px; color:#3b82f6; font-weight:bold; text-transform:uppercase;">Daily Challenge</div>
-            <b style="font-size:16px; color:#1e293b; display:block; margin-bottom:5px;">{q['question']}</b>
-            <div style="margin-top:8px; color:#64748b; font-size:13px;">Topic: {q.get('topic', 'General')}</div>
-        </div>"""
+def dispatch(smtp, msg, recipient):
+    """Sends prepared message bytes over an already authenticated SMTP session."""
+    smtp.sendmail(SENDER_EMAIL, recipient, msg, mail_options=("BODY=8BITMIME",))
 
-    body = f"""
-    <div style="font-family: sans-serif; padding:20px; background:#f1f5f9;">
-        <div style="max-width:600px; margin:auto; background:white; border-radius:24px; padding:40px; border:1px solid #e2e8f0; box-shadow: 0 4px 6px -1px rgba(0,0,0,0.1);">
-            <div style="text-align:center; margin-bottom:30px;">
-                <h1 style="color:#2563eb; margin:0; font-size:28px;">Cloud Mastery Bot</h1>
-                <div style="display:inline-block; margin-top:15px; background:#dbeafe; color:#1e40af; padding:6px 16px; border-radius:20px; font-weight:bold; font-size:12px; letter-spacing:0.5px;">
-                    🔥 {streak} DAY STREAK
-                </div>
-            </div>
-            <p style="color:#475569; font-size:15px; line-height:1.6; text-align:center; margin-bottom:30px;">
-                Here is your daily <b>{exam}</b> question. Challenge yourself!
-            </p>
-            {q_html}
-            <div style="margin-top:40px; border-top:1px solid #f1f5f9; padding-top:25px; text-align:center;">
-                <a href="{manage_url}" style="display:inline-block; background:#1e293b; color:white; padding:14px 30px; border-radius:12px; text-decoration:none; font-weight:bold; font-size:14px;">Manage Subscription</a>
-            </div>
-        </div>
-    </div>"""
-    
-    msg = MIMEMultipart()
-    msg['Subject'] = f"🚀 Day {streak}: Your {exam} Question"
-    msg['From'] = f"Cloud Mastery Bot <{SENDER_EMAIL}>"
-    msg['To'] = email
-    msg.attach(MIMEText(body, 'html'))
-    
+# One SMTP session per worker thread; every session is tracked so it can be closed at the end
+_smtp_local = threading.local()
+_smtp_sessions = []
+_smtp_sessions_lock = threading.Lock()
+
+def _get_smtp():
+    """Returns the calling worker's SMTP session, opening or rotating it as needed."""
+    smtp = getattr(_smtp_local, 'smtp', None)
+    sent = getattr(_smtp_local, 'sent', 0)
+    idle = time.monotonic() - getattr(_smtp_local, 'last_used', 0)
+
+    # Gmail drops long-lived and idle sessions, so probe every few messages or after
+    # a quiet spell (e.g. a pre-warmed session waiting on a slow pack), and rotate at the cap
+    if smtp is not None and ((sent and sent % SMTP_HEALTHCHECK_EVERY == 0) or idle > SMTP_IDLE_PROBE_SECONDS):
+        if sent >= SMTP_MAX_PER_SESSION or not smtp_alive(smtp):
+            _drop_smtp()
+            smtp = None
+
+    if smtp is None:
+        smtp = open_smtp()
+        _smtp_local.smtp = smtp
+        _smtp_local.sent = 0
+        _smtp_local.last_used = time.monotonic()
+        with _smtp_sessions_lock:
+            _smtp_sessions.append(smtp)
+    return smtp
+
+def _drop_smtp():
+    """Closes and forgets the calling worker's SMTP session."""
+    smtp = getattr(_smtp_local, 'smtp', None)
+    _smtp_local.smtp = None
+    if smtp is not None:
+        with _smtp_sessions_lock:
+            if smtp in _smtp_sessions:
+                _smtp_sessions.remove(smtp)
+        close_smtp(smtp)
+
+def close_all_smtp():
+    """Closes every worker's SMTP session once dispatch is finished."""
+    with _smtp_sessions_lock:
+        sessions = list(_smtp_sessions)
+        _smtp_sessions.clear()
+    for smtp in sessions:
+        close_smtp(smtp)
+
+def send_one(user_data, q_html):
+    """Sends one subscriber's email on the calling worker's persistent SMTP session."""
+    email = user_data.get('email', user_data.get('id'))
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as s:
-            s.login(SENDER_EMAIL, SENDER_PASSWORD)
-            s.sendmail(SENDER_EMAIL, email, msg.as_string())
-        print(f"📧 Email sent successfully to {email}")
-        return True
+        # A malformed subscriber doc fails only its own send, never the dispatch loop
+        msg = build_message(user_data, q_html)
+        try:
+            dispatch(_get_smtp(), msg, email)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+            # 421 means the server is closing the session, so treat it like a disconnect
+            if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421:
+                raise
+            log("    ⚠️ SMTP session dropped. Reconnecting...")
+            _drop_smtp()
+            dispatch(_get_smtp(), msg, email)
     except Exception as e:
-        print(f"❌ SMTP failed for {email}: {e}")
+        log(f"❌ SMTP failed for {email}: {e}")
         return False
 
+    _smtp_local.sent += 1
+    _smtp_local.last_used = time.monotonic()
+    log(f"📧 Email sent successfully to {email}")
+    return True
+
 if __name__ == "__main__":
-    print(f"🚀 Starting dispatch at {datetime.now(timezone.utc)}")
+    log(f"🚀 Starting dispatch at {datetime.now(timezone.utc)}")
     
+    db = get_db()
     sub_ref = db.collection('artifacts').document(APP_ID).collection('public').document('data').collection('subscribers')
-    subs = sub_ref.where(filter=FieldFilter('status', '==', 'active')).stream()
+    # Only the fields the dispatch reads are pulled over the wire
+    subs = sub_ref.where(filter=FieldFilter('status', '==', 'active')).select(['email', 'examType', 'streak']).stream()
     
-    sub_list = []
-    needed_exams = set()
+    # Each exam's pack starts loading the moment the stream first reveals it
+    pack_pool = ThreadPoolExecutor(max_workers=PACK_WORKERS)
+    pack_futures = {}
+    subs_by_exam = defaultdict(list)
     for doc in subs:
         u = doc.to_dict()
         u['id'] = doc.id
-        sub_list.append(u)
-        needed_exams.add(u.get('examType', 'AZ-900'))
+        exam = u.get('examType', 'AZ-900')
+        if exam not in subs_by_exam:
+            log(f"📦 Checking Question Bank for {exam}...")
+            pack_futures[pack_pool.submit(get_daily_pack, exam)] = exam
+        subs_by_exam[exam].append(u)
     
-    print(f"👥 Subscribers Found: {len(sub_list)}")
-
-    packs = {}
-    for exam in list(needed_exams):
-        print(f"📦 Checking Question Bank for {exam}...")
-        pack = get_question_from_bank(exam)
-        if pack:
-            packs[exam] = pack
-        else:
-            print(f"❌ Could not retrieve or generate questions for {exam}.")
+    subscriber_count = sum(len(users) for users in subs_by_exam.values())
+    log(f"👥 Subscribers Found: {subscriber_count}")
+    if not subs_by_exam:
+        log("ℹ️ No active subscribers. Nothing to dispatch.")
+        sys.exit(0)
 
     successful_sends = 0
-    for u in sub_list:
-        exam = u.get('examType', 'AZ-900')
-        if exam in packs:
-            if send_email(u, packs[exam]):
-                sub_ref.document(u['id']).update({
-                    'streak': u.get('streak', 0) + 1,
-                    'lastDelivery': datetime.now(timezone.utc)
-                })
-                successful_sends += 1
+    batch = db.batch()
+    pending_writes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=SMTP_WORKERS) as send_pool:
+            # Log the SMTP workers in now, so the TLS + AUTH handshakes overlap pack loading
+            for _ in range(min(SMTP_WORKERS, subscriber_count)):
+                send_pool.submit(_get_smtp)
+
+            sends = {}
+            # Packs are consumed as they complete, so warm exams start mailing while cold ones refill
+            for future in as_completed(pack_futures):
+                exam = pack_futures[future]
+                # Other exams may already be mailing, so one bad pack must not abort the run
+                try:
+                    pack = future.result()
+                    # Decode once per exam; every subscriber of the exam shares the list
+                    q_list = json.loads(pack) if pack else None
+                    q_html = render_questions_html(q_list) if q_list else None
+                except Exception as e:
+                    log(f"    ⚠️ Pack for {exam} failed: {e}")
+                    q_html = None
+                if not q_html:
+                    log(f"❌ Could not retrieve or generate questions for {exam}.")
+                    continue
+
+                for u in subs_by_exam[exam]:
+                    sends[send_pool.submit(send_one, u, q_html)] = u
+            pack_pool.shutdown()
+
+            for future in as_completed(sends):
+                u = sends[future]
+                try:
+                    delivered = future.result()
+                except Exception as e:
+                    log(f"❌ Send failed for {u.get('email', u['id'])}: {e}")
+                    continue
+                if delivered:
+                    batch.update(sub_ref.document(u['id']), {
+                        'streak': u.get('streak', 0) + 1,
+                        'lastDelivery': firestore.SERVER_TIMESTAMP
+                    })
+                    pending_writes += 1
+                    successful_sends += 1
+                    if pending_writes >= BATCH_LIMIT:
+                        batch.commit()
+                        batch = db.batch()
+                        pending_writes = 0
+    finally:
+        # Streak updates already queued are still committed if the run fails part-way
+        close_all_smtp()
+        if pending_writes:
+            batch.commit()
     
-    print(f"✅ Finished. Successfully delivered {successful_sends} emails.")
+    log(f"✅ Finished. Successfully delivered {successful_sends} emails.")